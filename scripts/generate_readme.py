@@ -3,25 +3,46 @@
 # Copyright (C) 2024 Argmax, Inc. All Rights Reserved.
 #
 import argparse
-import evaluate
+import importlib.util
 import json
 import os
-from collections import defaultdict
-
-import pandas as pd
+import re
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import chain
+from operator import itemgetter
+
+# hf_transfer speeds up eval downloads on fast links. This must be set before
+# huggingface_hub is imported. Opt out with HF_HUB_ENABLE_HF_TRANSFER=0
+if importlib.util.find_spec("hf_transfer") is not None:
+    os.environ.setdefault("HF_HUB_ENABLE_HF_TRANSFER", "1")
+
+import jiwer
+import numpy as np
 from argmaxtools.utils import get_logger
-from huggingface_hub import HfApi, snapshot_download
+from huggingface_hub import HfApi, constants, hf_hub_download, snapshot_download
+from huggingface_hub.utils import LocalEntryNotFoundError
 
 from whisperkit._constants import EVALS_REPO_ID, MODEL_REPO_ID
 
-wer_metric = evaluate.load("wer")
+try:
+    # Faster parsing for large eval JSONs
+    import orjson
+except ImportError:
+    orjson = None
 
 logger = get_logger(__name__)
 
+# If set, evals already in the local HF Hub cache are used without any network calls
+USE_CACHED_EVALS = os.getenv("WKT_USE_CACHE", "0") == "1" or constants.HF_HUB_OFFLINE
+
 QOI_KEY = "QoI (↑)"
 FILE_SIZE_KEY = "File Size (MB)"
 WER_KEY = "WER (↓)"
 COMMIT_KEY = "Code Commit"
+MODEL_KEY = ""
+TABLE_COLUMNS = [MODEL_KEY, WER_KEY, QOI_KEY, FILE_SIZE_KEY, COMMIT_KEY]
 
 HF_HUB_DATASET_CARD_YAML_PREFIX = """
 ---
@@ -134,6 +155,12 @@ DATASET_CAPTIONS = {
     "earnings22": "Long-Form Audio (>1hr/clip) - 120 hours of earnings call recordings in English with various accents",
 }
 
+# Eval JSON with the metadata fields compared across evals, extracted once by get_eval_info
+EvalInfo = namedtuple("EvalInfo", "eval link wer commit_hash os_build wkt_commit")
+
+# Stripped from model versions to keep table row names short
+MODEL_PREFIX_RE = re.compile(r"^(openai_whisper-|distil-whisper_)")
+
 REPO_URLS = {
     "whisper.cpp": "https://github.com/ggerganov/whisper.cpp",
     "WhisperKit": "https://github.com/argmaxinc/WhisperKit"
@@ -165,90 +192,83 @@ def cli():
     )
     args = parser.parse_args()
 
-    readme = ""
+    readme_parts = []
+
+    # Each mapping is <reference>:<optimized1,...,optimizedN>
+    mappings = [mapping.split(":") for mapping in args.reference_to_optimized_mapping]
 
     for dataset_name in args.dataset_names:
-        readme += f"\n## Dataset: `{dataset_name}`\n{DATASET_CAPTIONS[dataset_name]}\n"
+        readme_parts.append(f"\n## Dataset: `{dataset_name}`\n{DATASET_CAPTIONS[dataset_name]}\n")
         "-------------------------------------------------"
 
-        # Quality-of-Inference (QoI) certifications for Whisper models
-        for mapping in args.reference_to_optimized_mapping:
-            results_dict = {}
-            reference, optimized_csv = mapping.split(":")
-            results_dict[WER_KEY] = defaultdict(float)
-            results_dict[QOI_KEY] = defaultdict(float)
-            results_dict[FILE_SIZE_KEY] = defaultdict(int)
-            results_dict[COMMIT_KEY] = defaultdict(str)
-
-            # Fetch the reference eval results
+        # Fetch each reference eval and compute its values once, even if it
+        # is shared by multiple mappings
+        references = list(dict.fromkeys(reference for reference, _ in mappings))
+        reference_evals = []
+        for reference in references:
             reference_code_repo, reference_model = parse_name(reference)
+            reference_evals.append(get_latest_eval(
+                reference_code_repo, dataset_name, reference_model))
 
-            reference_eval, reference_link = get_latest_eval(
-                reference_code_repo, dataset_name, reference_model)
+        # Sample average WER for reference models
+        reference_wers = compute_average_wers(
+            [reference_eval["results"] for reference_eval, _ in reference_evals])
 
-            reference_key = reference.rsplit('/')[
-                -1].replace('openai_whisper-', '').replace('distil-whisper_', '')
-            if reference_code_repo == "WhisperKit":
-                reference_key = \
-                    f"[{reference_key}]" \
-                    f"({get_model_link(reference_model)}) "
-            else:
-                reference_key = reference_key + f" ({reference_code_repo})"
+        reference_infos = {}
+        reference_rows = {}
+        for reference, (reference_eval, reference_link), reference_wer in zip(
+                references, reference_evals, reference_wers):
+            reference_code_repo, reference_model = parse_name(reference)
+            reference_info = get_eval_info(reference_eval, reference_link, reference_wer)
+            reference_infos[reference] = reference_info
 
             # Fill reference model version values
-            results_dict[QOI_KEY][reference_key] = 100.  # By definition of QoI
-            results_dict[FILE_SIZE_KEY][reference_key] = \
-                REFERENCE_MODEL_FILE_SIZES[reference]
-
-            # Sample average WER for reference model
-            results_dict[WER_KEY][reference_key] = \
-                f"[{compute_average_wer(reference_eval['results'])}]({reference_link})"
-
-            # Add commit hash for reference results
-            commit_hash = reference_eval["metadata"]["inference_context"]["code_spec"]["code_commit_hash"]
-            if commit_hash is not None:
-                results_dict[COMMIT_KEY][reference_key] = \
-                    f"[Link]({REPO_URLS[reference_code_repo]}/commit/{commit_hash[:7]})"
-            else:
-                results_dict[COMMIT_KEY][reference_key] = "N/A"
+            reference_rows[reference] = {
+                MODEL_KEY: get_display_key(reference_code_repo, reference_model),
+                WER_KEY: f"[{reference_info.wer}]({reference_info.link})",
+                QOI_KEY: 100.,  # By definition of QoI
+                FILE_SIZE_KEY: REFERENCE_MODEL_FILE_SIZES[reference],
+                COMMIT_KEY: get_commit_link(reference_code_repo, reference_info.commit_hash),
+            }
 
-            # Fill optimized model version values
-            for optimized in optimized_csv.split(","):
-                optimized_code_repo, optimized_model = parse_name(optimized)
+        # Quality-of-Inference (QoI) certifications for Whisper models
+        for reference, optimized_csv in mappings:
+            reference_info = reference_infos[reference]
+            rows = [reference_rows[reference]]
+
+            # Fetch optimized model version evals concurrently (network-bound)
+            optimized_names = optimized_csv.split(",")
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                optimized_futures = []
+                for optimized in optimized_names:
+                    optimized_code_repo, optimized_model = parse_name(optimized)
+                    optimized_futures.append(executor.submit(
+                        get_latest_eval, optimized_code_repo, dataset_name, optimized_model))
+
+            optimized_evals = {}
+            for optimized, optimized_future in zip(optimized_names, optimized_futures):
                 try:
-                    optimized_eval, optimized_link = get_latest_eval(
-                        optimized_code_repo, dataset_name, optimized_model)
+                    optimized_evals[optimized] = optimized_future.result()
                 except Exception as e:
                     logger.warning(f"Could not fetch eval JSON for {optimized}: {e}")
-                    continue
 
-                optimized_key = optimized.rsplit('/')[
-                    -1].replace('openai_whisper-', '').replace('distil-whisper_', '')
-                if optimized_code_repo == "WhisperKit":
-                    optimized_key = \
-                        f"[{optimized_key}]" \
-                        f"({get_model_link(optimized_model)}) "
-                else:
-                    optimized_key = optimized_key + f" ({optimized_code_repo})"
+            # Sample average WER for all optimized models in a single pass
+            optimized_wers = compute_average_wers(
+                [optimized_eval["results"] for optimized_eval, _ in optimized_evals.values()])
+
+            # Fill optimized model version values
+            for (optimized, (optimized_eval, optimized_link)), optimized_wer in zip(
+                    optimized_evals.items(), optimized_wers):
+                optimized_code_repo, optimized_model = parse_name(optimized)
+                optimized_info = get_eval_info(optimized_eval, optimized_link, optimized_wer)
 
                 # Verify fetched evals are comparable
-                logger.info(f"Compare {optimized_link} vs {reference_link}")
-                verify_apples_to_apples(reference_eval, optimized_eval)
+                logger.info(f"Compare {optimized_info.link} vs {reference_info.link}")
+                verify_apples_to_apples(reference_info, optimized_info)
                 qoi = compute_quality_of_inference(
-                    reference_eval["results"],
-                    optimized_eval["results"]
+                    reference_info.eval["results"],
+                    optimized_info.eval["results"]
                 )
-                results_dict[QOI_KEY][optimized_key] = qoi["no_regression"]
-                results_dict[WER_KEY][optimized_key] = \
-                    f"[{compute_average_wer(optimized_eval['results'])}]({optimized_link})"
-
-                # Add commit hash for reference results
-                commit_hash = optimized_eval["metadata"]["inference_context"]["code_spec"]["code_commit_hash"]
-                if commit_hash is not None:
-                    results_dict[COMMIT_KEY][optimized_key] = \
-                        f"[Link]({REPO_URLS[optimized_code_repo]}/commit/{commit_hash[:7]})"
-                else:
-                    results_dict[COMMIT_KEY][optimized_key] = "N/A"
 
                 # TODO(atiorh): Read remote git file size
                 if optimized in REFERENCE_MODEL_FILE_SIZES:
@@ -260,12 +280,19 @@ def cli():
                     else:
                         file_size = "N/A"
 
-                results_dict[FILE_SIZE_KEY][optimized_key] = file_size
+                rows.append({
+                    MODEL_KEY: get_display_key(optimized_code_repo, optimized_model),
+                    WER_KEY: f"[{optimized_info.wer}]({optimized_info.link})",
+                    QOI_KEY: qoi["no_regression"],
+                    FILE_SIZE_KEY: file_size,
+                    COMMIT_KEY: get_commit_link(optimized_code_repo, optimized_info.commit_hash),
+                })
 
             # Generate the README
-            markdown_table = pd.DataFrame.from_dict(results_dict).to_markdown()
-            readme += f"\n{markdown_table}\n"
+            markdown_table = get_markdown_table(TABLE_COLUMNS, rows)
+            readme_parts.append(f"\n{markdown_table}\n")
 
+    readme = "".join(readme_parts)
     logger.info("Generated README:\n" + readme)
 
     if args.upload_results:
@@ -275,22 +302,23 @@ def cli():
         with open(temp_path, "w") as f:
             f.write(hub_readme)
 
-        # Upload to f'hf.co/datasets/{EVALS_REPO_ID}'
+        # Upload to f'hf.co/datasets/{EVALS_REPO_ID}' and f'hf.co/{MODEL_REPO_ID}' concurrently
         api = HfApi()
-        api.upload_file(
-            path_in_repo="README.md",
-            path_or_fileobj=temp_path,
-            repo_id=EVALS_REPO_ID,
-            repo_type="dataset",
-            commit_message="whisperkittools generated README.md",
-        )
-        api.upload_file(
-            path_in_repo="README.md",
-            path_or_fileobj=temp_path,
-            repo_id=MODEL_REPO_ID,
-            repo_type="model",
-            commit_message="whisperkittools generated README.md",
-        )
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            upload_futures = [
+                executor.submit(
+                    api.upload_file,
+                    path_in_repo="README.md",
+                    path_or_fileobj=temp_path,
+                    repo_id=repo_id,
+                    repo_type=repo_type,
+                    commit_message="whisperkittools generated README.md",
+                )
+                for repo_id, repo_type in [(EVALS_REPO_ID, "dataset"), (MODEL_REPO_ID, "model")]
+            ]
+        # Re-raise upload errors, if any
+        for upload_future in upload_futures:
+            upload_future.result()
         logger.info("Uploaded to HF Hub")
 
 
@@ -301,20 +329,14 @@ def compute_quality_of_inference(reference, optimized, metric="wer"):
     - no_regression: the percentage of samples that didn't regress
     - improved: the percentage of samples that improved (indicentally)
     """
-    no_regression = 0
-    improved = 0
-    count = 0
-
-    for ref, opt in zip(reference, optimized):
-        if opt[metric] <= ref[metric]:
-            no_regression += 1
-        if opt[metric] < ref[metric]:
-            improved += 1
-        count += 1
+    # Only compare the overlapping samples (same behavior as zip)
+    count = min(len(reference), len(optimized))
+    ref = np.fromiter((r[metric] for r in reference[:count]), dtype=np.float64, count=count)
+    opt = np.fromiter((o[metric] for o in optimized[:count]), dtype=np.float64, count=count)
 
     return dict(
-        no_regression=round(no_regression / count, 3) * 100.,
-        improved=round(improved / count, 3) * 100.,
+        no_regression=round(float((opt <= ref).mean()), 3) * 100.,
+        improved=round(float((opt < ref).mean()), 3) * 100.,
     )
 
 
@@ -332,63 +354,174 @@ def parse_name(result, default_code_repo="WhisperKit"):
     return code_repo, model
 
 
-def get_latest_eval(code_repo, dataset_name, model_version, local_dir="external"):
+@lru_cache(maxsize=None)
+def list_eval_files():
+    f""" List all files in hf.co/datasets/{EVALS_REPO_ID} (once per run)
+    """
+    return tuple(HfApi().list_repo_files(EVALS_REPO_ID, repo_type="dataset"))
+
+
+def list_cached_eval_files(repo_rel_dir):
+    f""" List the eval JSONs under repo_rel_dir in the local HF Hub cache of
+    hf.co/datasets/{EVALS_REPO_ID} without any network calls
+    """
+    try:
+        snapshot_dir = snapshot_download(
+            repo_id=EVALS_REPO_ID,
+            repo_type="dataset",
+            local_files_only=True,
+        )
+    except LocalEntryNotFoundError:
+        return []
+
+    local_dir = os.path.join(snapshot_dir, repo_rel_dir)
+    if not os.path.isdir(local_dir):
+        return []
+    with os.scandir(local_dir) as entries:
+        return [entry.path for entry in entries if entry.name.endswith(".json")]
+
+
+# Memoized so that each (code_repo, dataset_name, model_version) is fetched and parsed once per run
+@lru_cache(maxsize=None)
+def get_latest_eval(code_repo, dataset_name, model_version):
     f""" Fetch the latest eval from hf.co/datasets/{EVALS_REPO_ID}
     for given code repo, model version and dataset
     """
-    os.makedirs(local_dir, exist_ok=True)
     repo_rel_dir = os.path.join(code_repo, model_version, dataset_name)
-    _ = snapshot_download(
-        repo_id=EVALS_REPO_ID,
-        repo_type="dataset",
-        local_dir=local_dir,
-        allow_patterns=os.path.join(repo_rel_dir, "*.json")
-    )
 
     # Filenames are chronological
-    all_results = sorted(os.listdir(os.path.join(local_dir, repo_rel_dir)))
-    if len(all_results) == 0:
-        raise FileNotFoundError(f"No eval results found for {repo_rel_dir}")
-    latest_result = os.path.join(local_dir, repo_rel_dir, all_results[-1])
+    cached_results = list_cached_eval_files(repo_rel_dir) if USE_CACHED_EVALS else []
+    if len(cached_results) > 0:
+        latest_result = max(cached_results)
+    else:
+        # Only download the latest one
+        all_results = [
+            f for f in list_eval_files()
+            if os.path.dirname(f) == repo_rel_dir and f.endswith(".json")
+        ]
+        if len(all_results) == 0:
+            raise FileNotFoundError(f"No eval results found for {repo_rel_dir}")
+
+        # Served from the shared HF Hub cache if already downloaded
+        latest_result = hf_hub_download(
+            repo_id=EVALS_REPO_ID,
+            filename=max(all_results),
+            repo_type="dataset",
+            etag_timeout=5,
+        )
 
     logger.info(f"Fetched {latest_result}")
-    with open(latest_result, "r") as f:
-        results = json.load(f)
+    with open(latest_result, "rb") as f:
+        results = orjson.loads(f.read()) if orjson is not None else json.load(f)
 
     hub_link = f"https://hf.co/datasets/{EVALS_REPO_ID}/tree/main/{repo_rel_dir}"
 
     return results, hub_link
 
 
-def verify_apples_to_apples(reference_eval, optimized_eval):
+def get_eval_info(eval_json, link, wer):
+    """ Extract the eval metadata used for comparisons and table values once
+    """
+    inference_context = eval_json["metadata"]["inference_context"]
+    return EvalInfo(
+        eval=eval_json,
+        link=link,
+        wer=wer,
+        commit_hash=inference_context["code_spec"]["code_commit_hash"],
+        os_build=inference_context["os_spec"]["os_build_number"],
+        wkt_commit=eval_json["metadata"]["whisperkittools_commit_hash"],
+    )
+
+
+def verify_apples_to_apples(reference_info, optimized_info):
     """ Compare metadata from the inference context for any potential discrepancies
     """
     # Verify evals were generated with the same WhisperKit code commit
-    hash1 = reference_eval["metadata"]["inference_context"]["code_spec"]["code_commit_hash"]
-    hash2 = optimized_eval["metadata"]["inference_context"]["code_spec"]["code_commit_hash"]
-    if hash1 != hash2:
+    if reference_info.commit_hash != optimized_info.commit_hash:
         logger.warning("Reference and optimized evals weren't generated with the same code commit!")
 
     # Verify evals were generated with the same OS version
-    osv1 = reference_eval["metadata"]["inference_context"]["os_spec"]["os_build_number"]
-    osv2 = optimized_eval["metadata"]["inference_context"]["os_spec"]["os_build_number"]
-    if osv1 != osv2:
+    if reference_info.os_build != optimized_info.os_build:
         logger.warning("Reference and optimized evals weren't generated with the same OS version!")
 
     # Verify whisperkittools commit that orchestrated the tests
-    wkt_commit_1 = reference_eval["metadata"]["whisperkittools_commit_hash"]
-    wkt_commit_2 = optimized_eval["metadata"]["whisperkittools_commit_hash"]
-    if wkt_commit_1 != wkt_commit_2:
+    if reference_info.wkt_commit != optimized_info.wkt_commit:
         logger.warning(
             "Reference and optimized evals weren't generated with the same "
             "whisperkittools commit")
 
 
-def compute_average_wer(results):
-    return round(wer_metric.compute(
-        references=[result["reference"] for result in results],
-        predictions=[result["prediction"] for result in results],
-    ) * 100., 2)
+def compute_average_wers(results_list):
+    """ Computes the average WER of each results list in `results_list`
+
+    All (reference, prediction) pairs are aligned with a single jiwer call and the
+    per-sample edit operations are then accumulated separately for each results list
+    """
+    if len(results_list) == 0:
+        return []
+
+    # jiwer calls len() on its inputs so they are materialized as lists
+    output = jiwer.process_words(
+        list(map(itemgetter("reference"), chain.from_iterable(results_list))),
+        list(map(itemgetter("prediction"), chain.from_iterable(results_list))),
+    )
+
+    average_wers = []
+    offset = 0
+    for results in results_list:
+        num_errors = 0
+        num_reference_words = 0
+        for alignment in output.alignments[offset:offset + len(results)]:
+            for chunk in alignment:
+                if chunk.type == "insert":
+                    num_errors += chunk.hyp_end_idx - chunk.hyp_start_idx
+                    continue
+                num_reference_words += chunk.ref_end_idx - chunk.ref_start_idx
+                if chunk.type != "equal":
+                    num_errors += chunk.ref_end_idx - chunk.ref_start_idx
+        offset += len(results)
+        average_wers.append(round(num_errors / num_reference_words * 100., 2))
+
+    return average_wers
+
+
+def get_display_key(code_repo, model_version):
+    """ Table row name for a model version, e.g. `[large-v3](<model link>) ` for
+    WhisperKit or `large-v3 (whisper.cpp)` otherwise
+    """
+    key = MODEL_PREFIX_RE.sub("", model_version)
+    if code_repo == "WhisperKit":
+        return f"[{key}]({get_model_link(model_version)}) "
+    return f"{key} ({code_repo})"
+
+
+def get_markdown_table(columns, rows):
+    """ Format row dicts as a markdown table with the given columns
+    (floats formatted and numeric columns right-aligned like tabulate)
+    """
+    def format_cell(cell):
+        return f"{cell:g}" if isinstance(cell, float) else str(cell)
+
+    def is_numeric(cell):
+        return isinstance(cell, (int, float)) and not isinstance(cell, bool)
+
+    separators = [
+        "---:" if len(rows) > 0 and all(is_numeric(row[column]) for row in rows) else ":---"
+        for column in columns
+    ]
+    lines = [
+        "| " + " | ".join(columns) + " |",
+        "|" + "|".join(separators) + "|",
+    ]
+    for row in rows:
+        lines.append("| " + " | ".join(format_cell(row[column]) for column in columns) + " |")
+    return "\n".join(lines)
+
+
+def get_commit_link(code_repo, commit_hash):
+    if commit_hash is None:
+        return "N/A"
+    return f"[Link]({REPO_URLS[code_repo]}/commit/{commit_hash[:7]})"
 
 
 def get_model_link(model_version):
@@ -21,12 +21,16 @@ setup(
         "datasets",
         "librosa",
         "soundfile",
-        "jiwer",
-        "tabulate",
+        "jiwer>=3.0",
         "mlx",
         "tiktoken",
         "openai"
     ],
+    extras_require={
+        # Faster downloads and parsing for whisperkit-generate-readme
+        "hf_transfer": ["hf_transfer"],
+        "orjson": ["orjson"],
+    },
     packages=find_packages(),
     entry_points={
         "console_scripts": [
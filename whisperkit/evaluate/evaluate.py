@@ -3,11 +3,11 @@
 # Copyright (C) 2024 Argmax, Inc. All Rights Reserved.
 #
 import time
-from functools import partial
+from functools import lru_cache, partial
 from multiprocessing import Pool
 from typing import Union
 
-import evaluate
+import evaluate as hf_evaluate
 import tqdm
 from argmaxtools.utils import get_logger
 
@@ -18,7 +18,13 @@ from whisperkit.evaluate.normalize_en import EnglishTextNormalizer
 logger = get_logger(__name__)
 
 text_normalizer = EnglishTextNormalizer()
-wer_metric = evaluate.load("wer")
+
+
+@lru_cache(maxsize=None)
+def wer_metric():
+    """ Load the WER metric on first use instead of at import time
+    """
+    return hf_evaluate.load("wer")
 
 
 def evaluate(whisper_pipeline: Union[pipelines.WhisperPipeline, pipelines.WhisperOpenAIAPI],
@@ -66,7 +72,7 @@ def evaluate(whisper_pipeline: Union[pipelines.WhisperPipeline, pipelines.Whispe
 
     total_elapsed = time.time() - begin
 
-    avg_wer = wer_metric.compute(
+    avg_wer = wer_metric().compute(
         references=[result["reference"] for result in results],
         predictions=[result["prediction"] for result in results],
     )
@@ -155,7 +161,7 @@ def evaluate_sample(sample, whisper_pipeline):
         prediction=normalized_predicted_text,
         prediction_duration=duration,
         file=audio_file_path .split('/')[-1],
-        wer=wer_metric.compute(
+        wer=wer_metric().compute(
             references=[sample["norm_text"]],
             predictions=[normalized_predicted_text]
         ),